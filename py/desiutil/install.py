@@ -8,15 +8,18 @@ desiutil.install
 This package contains code for installing DESI software products.
 """
 import os
+import re
 import sys
-import tarfile
 import stat
 import shutil
-import requests
-from io import BytesIO
-from subprocess import Popen, PIPE
+from collections import ChainMap, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from graphlib import TopologicalSorter, CycleError
+from signal import SIGTERM
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired, run
+from threading import Thread
 from types import MethodType
-from pkg_resources import resource_filename
 from .git import last_tag
 from .log import get_logger, DEBUG, INFO
 from .modules import (init_modules, configure_module,
@@ -75,6 +78,19 @@ known_products = {
     }
 
 
+#
+# Harmless warnings that may appear on STDERR during a Python install.
+#
+_ignore_install_warning = re.compile(r'(warning: |)no( previously-included | )(directories|files)|astropy[_-]helpers',
+                                     re.IGNORECASE)
+
+
+#
+# Match the product loaded by a line in a module file.
+#
+_module_load = re.compile(r'\s*module\s+load\s+(\S+)')
+
+
 #
 # Reserved for future use.
 #
@@ -86,6 +102,49 @@ known_products = {
 #                       'simqso'])
 
 
+_session = None
+
+#
+# Connect and read timeouts, in seconds, for HTTP requests.
+#
+_timeout = (5, 30)
+
+
+def get_session():
+    """Get the HTTP session shared by all queries to GitHub.
+
+    The session is created on first use.  Reusing it allows consecutive
+    requests to share a connection.
+
+    Returns
+    -------
+    :class:`requests.Session`
+        The shared session.
+    """
+    global _session
+    if _session is None:
+        #
+        # requests is slow to import, and is not needed for --help.
+        #
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        _session = Session()
+        #
+        # Session() already asks for gzip-compressed responses.
+        #
+        # Return the final response when retries run out, so that
+        # raise_for_status() reports the actual HTTP error.
+        #
+        retry = Retry(total=3, backoff_factor=0.3,
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        _session.mount('https://', HTTPAdapter(pool_connections=4,
+                                               pool_maxsize=4,
+                                               max_retries=retry))
+    return _session
+
+
 def dependencies(modulefile):
     """Process the dependencies for a software product.
 
@@ -105,12 +164,172 @@ def dependencies(modulefile):
     ValueError
         If `modulefile` can't be found.
     """
-    if not os.path.exists(modulefile):
+    try:
+        st = os.stat(modulefile)
+    except OSError:
         raise ValueError("Modulefile {0} does not exist!".format(modulefile))
+    return list(_dependencies(modulefile, st.st_mtime_ns, st.st_size))
+
+
+@lru_cache(maxsize=64)
+def _dependencies(modulefile, mtime, size):
+    """Parse the dependencies in a module file.
+
+    The modification time and size of `modulefile` are part of the cache key,
+    so that a changed file is always parsed again.
+
+    Parameters
+    ----------
+    modulefile : :class:`str`
+        Name of the module file containing dependencies.
+    mtime : :class:`int`
+        Modification time of `modulefile` in nanoseconds.
+    size : :class:`int`
+        Size of `modulefile`.
+
+    Returns
+    -------
+    :func:`tuple`
+        The dependencies.
+    """
     with open(modulefile) as m:
-        lines = m.readlines()
-    return [l.strip().split()[2] for l in lines if
-            l.strip().startswith('module load')]
+        return tuple([mm.group(1) for mm in map(_module_load.match, m) if mm])
+
+
+def dependency_order(deps, module_dir=None):
+    """Sort dependencies so that every product follows its own dependencies.
+
+    Parameters
+    ----------
+    deps : :class:`list`
+        A list of dependencies, as returned by :func:`dependencies`.
+    module_dir : :class:`str`, optional
+        Directory containing installed module files.  The module files of
+        `deps` found here are examined, recursively, for dependencies.
+
+    Returns
+    -------
+    :class:`list`
+        The dependencies in an order such that each product is loaded
+        only after any other product in `deps` that it depends on.
+        If no ordering can be found, or if a module file loads a
+        different version of a product than the one in `deps`,
+        `deps` is returned unchanged.
+    """
+    if module_dir is None:
+        return deps
+
+    def direct_requires(d):
+        """Find the products that `d` depends on directly.
+        """
+        modulefile = os.path.join(module_dir, d)
+        if os.path.isfile(modulefile):
+            return dependencies(modulefile)
+        return []
+    #
+    # Module files on shared filesystems are slow to read one at a time,
+    # so read each level of the dependency tree concurrently.
+    #
+    direct = dict()
+    todo = list(dict.fromkeys(deps))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        while todo:
+            for d, dd in zip(todo, executor.map(direct_requires, todo)):
+                direct[d] = dd
+            todo = list(dict.fromkeys(dd for d in todo for dd in direct[d]
+                                      if dd not in direct))
+    requires = dict()
+
+    def find_requires(d):
+        """Find all products that `d` depends on.
+        """
+        if d in requires:
+            return requires[d]
+        requires[d] = set()
+        for dd in direct[d]:
+            requires[d].add(dd)
+            requires[d] |= find_requires(dd)
+        return requires[d]
+
+    base = dict((d.split('/')[0], d) for d in deps)
+    graph = TopologicalSorter()
+    for d in deps:
+        predecessors = list()
+        for r in find_requires(d):
+            b = r.split('/')[0]
+            if b not in base or base[b] == d:
+                continue
+            if '/' in r and r != base[b]:
+                #
+                # Loading d after base[b] would replace the version
+                # requested in deps, so keep the original order.
+                #
+                return deps
+            predecessors.append(base[b])
+        graph.add(d, *predecessors)
+    try:
+        return list(graph.static_order())
+    except CycleError:
+        return deps
+
+
+def loaded_modules():
+    """Find the base names of the currently-loaded Modules.
+
+    Returns
+    -------
+    :class:`set`
+        The names of the loaded Modules, without versions, *e.g.*
+        ``{'desiutil', 'desispec'}``.  The set will be empty if
+        :envvar:`LOADEDMODULES` is not defined.
+    """
+    return set(m.split('/')[0] for m in
+               os.environ.get('LOADEDMODULES', '').split(':') if m)
+
+
+def available_cpus():
+    """Count the CPUs that this process is allowed to use.
+
+    On shared nodes this may be fewer than the number of CPUs in the
+    machine, *e.g.* in a batch job or container.
+
+    Returns
+    -------
+    :class:`int`
+        The number of available CPUs, at least 1.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _positive_int(value):
+    """Convert a command-line argument to a positive integer.
+
+    Parameters
+    ----------
+    value : :class:`str`
+        The argument.
+
+    Returns
+    -------
+    :class:`int`
+        The converted argument.
+
+    Raises
+    ------
+    :exc:`argparse.ArgumentTypeError`
+        If `value` is not a positive integer.
+    """
+    from argparse import ArgumentTypeError
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise ArgumentTypeError("{0} is not a positive integer".format(value))
+    return n
 
 
 class DesiInstallException(Exception):
@@ -156,6 +375,7 @@ class DesiInstall(object):
         The only thing done here is setting up the logging infrastructure.
         """
         self.log = get_logger(INFO, timestamp=True)
+        self._nersc_dir = dict()
         return
 
     def get_options(self, test_args=None):
@@ -207,6 +427,13 @@ class DesiInstall(object):
                             dest='force',
                             help=('Overwrite any existing installation of ' +
                                   'this product/version.'))
+        parser.add_argument('-j', '--jobs', action='store', type=_positive_int,
+                            dest='jobs', default=self.default_jobs(),
+                            metavar='N',
+                            help=('Number of parallel jobs used to copy ' +
+                                  'and compile the product ' +
+                                  '(default $DESIINSTALL_JOBS or the ' +
+                                  'number of available CPUs).'))
         parser.add_argument('-k', '--keep', action='store_true',
                             dest='keep',
                             help='Keep the exported build directory.')
@@ -303,16 +530,22 @@ class DesiInstall(object):
         DesiInstallException
             If the product and version inputs didn't make sense.
         """
+        #
+        # Products added with -p override known_products for this install
+        # only, without modifying the module-level dictionary.
+        #
+        additional = dict()
         if self.options.additional is not None:
             for k in self.options.additional:
                 a = k.split(':', 1)
-                known_products[a[0]] = a[1]
+                additional[a[0]] = a[1]
+        self.known_products = ChainMap(additional, known_products)
         if '/' in self.options.product:
             self.baseproduct = os.path.basename(self.options.product)
         else:
             self.baseproduct = self.options.product
         try:
-            self.fullproduct = known_products[self.baseproduct]
+            self.fullproduct = self.known_products[self.baseproduct]
         except KeyError:
             self.fullproduct = 'https://github.com/desihub/{}'.format(
                     self.baseproduct)
@@ -378,10 +611,11 @@ class DesiInstall(object):
             If the subversion URL could not be found.
         """
         if self.github:
+            from requests.exceptions import HTTPError
             try:
-                r = requests.head(self.product_url)
+                r = get_session().head(self.product_url, timeout=_timeout)
                 r.raise_for_status()
-            except requests.exceptions.HTTPError:
+            except HTTPError:
                 message = ("Error {0:d} querying GitHub URL: " +
                            "{1}.").format(r.status_code, self.product_url)
                 self.log.critical(message)
@@ -390,120 +624,137 @@ class DesiInstall(object):
             command = [svn, '--non-interactive', '--username',
                        self.options.username, 'ls', self.product_url]
             self.log.debug(' '.join(command))
-            proc = Popen(command, universal_newlines=True,
-                         stdout=PIPE, stderr=PIPE)
-            out, err = proc.communicate()
+            status, out, err = self.run_command(command)
             self.log.debug(out)
-            if len(err) > 0:
+            if status != 0:
                 message = ("svn error while testing product URL: " +
                            "{0}.").format(err)
                 self.log.critical(message)
                 raise DesiInstallException(message)
         return True
 
-    def get_code(self):
+    def verify_branch(self):
+        """Ensure that a GitHub branch exists.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the branch exists.
+
+        Raises
+        ------
+        DesiInstallException
+            If the branch could not be found.
+        """
+        from requests.exceptions import HTTPError
+        #
+        # Only the status is needed, not the HTML of the page.
+        #
+        try:
+            r = get_session().head(os.path.join(self.fullproduct, 'tree',
+                                                self.baseversion),
+                                   allow_redirects=True, timeout=_timeout)
+            r.raise_for_status()
+        except HTTPError:
+            message = ("Branch {0} does not appear to exist. " +
+                       "HTTP response was {1:d}.").format(
+                       self.baseversion, r.status_code)
+            self.log.critical(message)
+            raise DesiInstallException(message)
+        return True
+
+    def get_code(self, verified=None):
         """Actually download the code.
 
         Following the standard order of execution, this is the first method
         that might actually modify the system (by downloading code).
 
+        Parameters
+        ----------
+        verified : :class:`concurrent.futures.Future`, optional
+            A pending call to :meth:`verify_url`.  It is allowed to complete
+            while any old working directory is removed, but before
+            any code is downloaded.
+
         Raises
         ------
         DesiInstallException
             If any download errors are detected.
         """
-        self.working_dir = os.path.join(os.path.abspath('.'),
-                                        '{0}-{1}'.format(self.baseproduct,
-                                                         self.baseversion))
-        if os.path.isdir(self.working_dir):
-            self.log.info("Detected old working directory, %s. Deleting...",
-                          self.working_dir)
-            self.log.debug("shutil.rmtree('%s')", self.working_dir)
-            if not self.options.test:
-                shutil.rmtree(self.working_dir)
+        cwd = os.path.abspath('.')
+        self.working_dir = os.path.join(cwd, '{0}-{1}'.format(self.baseproduct,
+                                                              self.baseversion))
+        #
+        # Network checks are independent of removing the old working
+        # directory, so overlap them.
+        #
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            if self.github and self.is_branch:
+                branch = executor.submit(self.verify_branch)
+            else:
+                branch = None
+            if os.path.isdir(self.working_dir):
+                self.log.info("Detected old working directory, %s. Deleting...",
+                              self.working_dir)
+                if not self.options.test:
+                    self.remove_tree(self.working_dir)
+            if verified is not None:
+                verified.result()
+            if branch is not None:
+                branch.result()
         if self.github:
             if self.is_branch:
-                try:
-                    r = requests.get(os.path.join(self.fullproduct, 'tree',
-                                                  self.baseversion))
-                    r.raise_for_status()
-                except requests.exceptions.HTTPError:
-                    message = ("Branch {0} does not appear to exist. " +
-                               "HTTP response was {1:d}.").format(
-                               self.baseversion, r.status_code)
-                    self.log.critical(message)
-                    raise DesiInstallException(message)
-                command = ['git', 'clone', '-q', '-b', self.baseversion,
+                #
+                # Branch installs derive their version string from the
+                # commit history, so fetch all commits on the branch,
+                # but defer downloading file contents not needed by
+                # the checkout.  A large clone on a slow connection can
+                # legitimately take a long time, so do not time out.
+                #
+                command = ['git', 'clone', '-q', '--filter=blob:none',
+                           '--single-branch', '-b', self.baseversion,
                            self.product_url, self.working_dir]
                 self.log.debug(' '.join(command))
                 if self.options.test:
-                    out, err = 'Test Mode.', ''
+                    status, out, err = 0, 'Test Mode.', ''
                 else:
-                    proc = Popen(command, universal_newlines=True,
-                                 stdout=PIPE, stderr=PIPE)
-                    out, err = proc.communicate()
+                    status, out, err = self.run_command(command, timeout=None)
                 self.log.debug(out)
-                if len(err) > 0:
+                if status != 0:
                     message = ("git error while downloading product code: " +
                                err)
                     self.log.critical(message)
                     raise DesiInstallException(message)
-                # if self.is_branch:
-                #     original_dir = os.getcwd()
-                #     self.log.debug("os.chdir('%s')", self.working_dir)
-                #     if not self.options.test:
-                #         os.chdir(self.working_dir)
-                #     command = ['git', 'checkout', '-q', '-b', self.baseversion,
-                #                'origin/'+self.baseversion]
-                #     self.log.debug(' '.join(command))
-                #     if self.options.test:
-                #         out, err = 'Test Mode.', ''
-                #     else:
-                #         proc = Popen(command, universal_newlines=True,
-                #                      stdout=PIPE, stderr=PIPE)
-                #         out, err = proc.communicate()
-                #     self.log.debug(out)
-                #     if len(err) > 0:
-                #         message = ("git error while changing branch:" +
-                #                    " {0}".format(err))
-                #         self.log.critical(message)
-                #         raise DesiInstallException(message)
-                #     self.log.debug("os.chdir('%s')", original_dir)
-                #     if not self.options.test:
-                #         os.chdir(original_dir)
             else:
                 if self.options.test:
                     self.log.debug("Test Mode. Skipping download of %s.",
                                    self.product_url)
                 else:
-                    try:
-                        r = requests.get(self.product_url)
-                        r.raise_for_status()
-                    except requests.exceptions.HTTPError:
-                        message = ("Error while downloading {0}, " +
-                                   "HTTP response was {1:d}.").format(
-                                   self.product_url, r.status_code)
-                        self.log.critical(message)
-                        raise DesiInstallException(message)
-                    try:
-                        tgz = BytesIO(r.content)
-                        tf = tarfile.open(fileobj=tgz, mode='r:gz')
-                        tf.extractall()
-                        tf.close()
-                        tgz.close()
-                        self.working_dir = os.path.join(os.path.abspath('.'),
-                                                        '{0}-{1}'.format(self.baseproduct,
-                                                                         self.baseversion))
-                        if self.baseversion.startswith('v'):
-                            nov = os.path.join(os.path.abspath('.'),
-                                               '{0}-{1}'.format(self.baseproduct,
-                                                                self.baseversion[1:]))
-                            if os.path.exists(nov):
-                                self.working_dir = nov
-                    except tarfile.TarError as e:
-                        message = "tar error while expanding product code!"
-                        self.log.critical(message)
-                        raise DesiInstallException(message)
+                    from requests.exceptions import HTTPError
+                    #
+                    # Stream the archive directly into tarfile, so that the
+                    # download is never held in memory in its entirety.
+                    #
+                    with get_session().get(self.product_url, stream=True,
+                                           timeout=_timeout) as r:
+                        try:
+                            r.raise_for_status()
+                        except HTTPError:
+                            message = ("Error while downloading {0}, " +
+                                       "HTTP response was {1:d}.").format(
+                                       self.product_url, r.status_code)
+                            self.log.critical(message)
+                            raise DesiInstallException(message)
+                        r.raw.decode_content = True
+                        if not self.extract(r.raw):
+                            message = "tar error while expanding product code!"
+                            self.log.critical(message)
+                            raise DesiInstallException(message)
+                    if self.baseversion.startswith('v'):
+                        nov = os.path.join(cwd, '{0}-{1}'.format(self.baseproduct,
+                                                                 self.baseversion[1:]))
+                        if os.path.exists(nov):
+                            self.working_dir = nov
         else:
             if self.is_branch:
                 get_svn = 'checkout'
@@ -514,26 +765,111 @@ class DesiInstall(object):
                        self.working_dir]
             self.log.debug(' '.join(command))
             if self.options.test:
-                out, err = 'Test Mode.', ''
+                status, out, err = 0, 'Test Mode.', ''
             else:
-                proc = Popen(command, universal_newlines=True,
-                             stdout=PIPE, stderr=PIPE)
-                out, err = proc.communicate()
+                status, out, err = self.run_command(command, timeout=None)
             self.log.debug(out)
-            if len(err) > 0:
+            if status != 0:
                 message = ("svn error while downloading product " +
                            "code: {0}".format(err))
                 self.log.critical(message)
                 raise DesiInstallException(message)
         return
 
+    def extract(self, fileobj):
+        """Expand a gzipped tar archive into the current directory.
+
+        The native :command:`tar` is used if it is available, since it is
+        much faster than :mod:`tarfile` for archives with many files.
+
+        Parameters
+        ----------
+        fileobj : file-like
+            A stream containing the archive.  It is only read sequentially.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the archive was expanded successfully.
+        """
+        tar = shutil.which('tar')
+        if tar is None:
+            import tarfile
+            self.log.debug("tarfile.open(fileobj=fileobj, mode='r|gz').extractall()")
+            try:
+                with tarfile.open(fileobj=fileobj, mode='r|gz') as tf:
+                    tf.extractall()
+            except tarfile.TarError:
+                return False
+            return True
+        command = [tar, '-xzf', '-']
+        self.log.debug(' '.join(command))
+        proc = Popen(command, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+        #
+        # Read STDERR while the archive is written, otherwise tar can
+        # fill the pipe with warnings and stop reading the archive.
+        #
+        err = deque(maxlen=1000)
+        reader = Thread(target=err.extend, args=(proc.stderr,))
+        reader.start()
+        try:
+            shutil.copyfileobj(fileobj, proc.stdin, 1 << 20)
+        except BrokenPipeError:
+            #
+            # tar exited early, the error will be in STDERR.
+            #
+            pass
+        except BaseException:
+            #
+            # For example, the download failed.
+            #
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            reader.join()
+            proc.wait()
+        if proc.returncode != 0:
+            self.log.debug(b''.join(err).decode(errors='replace'))
+            return False
+        return True
+
+    def remove_tree(self, path):
+        """Recursively remove a directory.
+
+        The native :command:`rm` is used if it is available, since it is
+        much faster than :func:`shutil.rmtree` for trees with many files,
+        such as git clones.
+
+        Parameters
+        ----------
+        path : :class:`str`
+            The directory to remove.
+        """
+        rm = shutil.which('rm')
+        if rm is not None:
+            command = [rm, '-rf', '--', path]
+            self.log.debug(' '.join(command))
+            status, out, err = self.run_command(command, timeout=None)
+            if status == 0:
+                return
+            self.log.debug(err)
+        #
+        # Let shutil.rmtree() raise a meaningful error, if there is one.
+        #
+        self.log.debug("shutil.rmtree('%s')", path)
+        shutil.rmtree(path)
+
     @property
     def build_type(self):
         """Determine the build type.
 
         Returns
         -------
-        :class:`set`
+        :class:`frozenset`
             A set containing the detected build types.
         """
         build_type = set(['plain'])
@@ -541,17 +877,25 @@ class DesiInstall(object):
             self.log.debug("Forcing build type: make")
             build_type.add('make')
         else:
-            if (os.path.exists(os.path.join(self.working_dir, 'pyproject.toml')) or os.path.exists(os.path.join(self.working_dir, 'setup.py'))):
+            #
+            # A single directory listing answers all of the questions below.
+            #
+            try:
+                with os.scandir(self.working_dir) as it:
+                    entries = dict((e.name, e) for e in it)
+            except OSError:
+                entries = dict()
+            if 'pyproject.toml' in entries or 'setup.py' in entries:
                 self.log.debug("Detected build type: py")
                 build_type.add('py')
-            elif os.path.exists(os.path.join(self.working_dir, 'Makefile')):
+            elif 'Makefile' in entries:
                 self.log.debug("Detected build type: make")
                 build_type.add('make')
             else:
-                if os.path.isdir(os.path.join(self.working_dir, 'src')):
+                if 'src' in entries and entries['src'].is_dir():
                     self.log.debug("Detected build type: src")
                     build_type.add('src')
-        return build_type
+        return frozenset(build_type)
 
     def anaconda_version(self):
         """Try to determine the exact DESI+Anaconda version from the
@@ -571,9 +915,33 @@ class DesiInstall(object):
         except ValueError:
             return 'current'
 
+    def default_jobs(self):
+        """Determine the default number of parallel jobs from the environment.
+
+        Returns
+        -------
+        :class:`int`
+            The value of :envvar:`DESIINSTALL_JOBS`, if it is set to a
+            positive integer, otherwise the number of available CPUs.
+        """
+        try:
+            jobs = os.environ['DESIINSTALL_JOBS']
+        except KeyError:
+            return available_cpus()
+        from argparse import ArgumentTypeError
+        try:
+            return _positive_int(jobs)
+        except ArgumentTypeError:
+            self.log.warning("Ignoring invalid value of DESIINSTALL_JOBS: '%s'.",
+                             jobs)
+            return available_cpus()
+
     def default_nersc_dir(self, nersc_host=None):
         """Set the directory where code will reside.
 
+        Results are cached for each combination of host and
+        DESI+Anaconda version.
+
         Parameters
         ----------
         nersc_host : :class:`str`, optional
@@ -585,10 +953,15 @@ class DesiInstall(object):
             Path to the host-specific install directory.
         """
         if nersc_host is None:
-            return self.default_nersc_dir_template.format(nersc_host=self.nersc,
-                                                          desiconda_version=self.options.anaconda)
-        return self.default_nersc_dir_template.format(nersc_host=nersc_host,
-                                                      desiconda_version=self.options.anaconda)
+            nersc_host = self.nersc
+        key = (nersc_host, self.options.anaconda)
+        try:
+            return self._nersc_dir[key]
+        except KeyError:
+            d = self.default_nersc_dir_template.format(nersc_host=nersc_host,
+                                                       desiconda_version=self.options.anaconda)
+            self._nersc_dir[key] = d
+            return d
 
     def set_install_dir(self):
         """Decide on an install directory.
@@ -616,9 +989,8 @@ class DesiInstall(object):
         if os.path.isdir(self.install_dir) and not self.options.test:
             if self.options.force:
                 self.unlock_permissions()
-                self.log.debug("shutil.rmtree('%s')", self.install_dir)
                 if not self.options.test:
-                    shutil.rmtree(self.install_dir)
+                    self.remove_tree(self.install_dir)
             else:
                 message = ("Install directory, {0}, already exists!".format(
                            self.install_dir))
@@ -659,36 +1031,46 @@ class DesiInstall(object):
         self.module_file = os.path.join(self.working_dir, 'etc',
                                         self.baseproduct + '.module')
         if not os.path.exists(self.module_file):
+            from pkg_resources import resource_filename
             self.module_file = resource_filename('desiutil',
                                                  'data/desiutil.module')
         if self.options.test:
             self.log.debug('Test Mode. Skipping loading of dependencies.')
             self.deps = list()
         else:
-            self.deps = dependencies(self.module_file)
+            #
+            # Only the first dependency on any product is used.
+            #
+            deps = list()
+            seen = set()
+            for d in dependencies(self.module_file):
+                base_d = d.split('/')[0]
+                if base_d not in seen:
+                    seen.add(base_d)
+                    deps.append(d)
+            self.deps = dependency_order(deps, self.nersc_module_dir)
+            loaded = loaded_modules()
             for d in self.deps:
                 base_d = d.split('/')[0]
-                if base_d in os.environ['LOADEDMODULES']:
+                if base_d in loaded:
                     m_command = 'switch'
                 else:
                     m_command = 'load'
                 self.log.debug("module('%s', '%s')", m_command, d)
                 self.module(m_command, d)
+                loaded.add(base_d)
         return self.deps
 
     @property
     def nersc_module_dir(self):
         """The directory that contains Module directories at NERSC.
         """
-        if hasattr(self, 'options'):
-            if self.options.root is not None:
-                return os.path.join(self.options.root, 'modulefiles')
-        if not hasattr(self, 'nersc'):
+        options = getattr(self, 'options', None)
+        if options is not None and options.root is not None:
+            return os.path.join(options.root, 'modulefiles')
+        if getattr(self, 'nersc', None) is None:
             return None
-        if self.nersc is None:
-            return None
-        else:
-            return os.path.join(self.default_nersc_dir(), 'modulefiles')
+        return os.path.join(self.default_nersc_dir(), 'modulefiles')
 
     def install_module(self):
         """Process the module file.
@@ -713,10 +1095,12 @@ class DesiInstall(object):
                                                 os.path.join(self.options.root, 'code'),
                                                 working_dir=self.working_dir,
                                                 dev=dev)
-        if self.nersc is None:
-            module_directory = os.path.join(self.options.root, 'modulefiles')
-        else:
-            module_directory = self.nersc_module_dir
+        #
+        # If --root is not set, set_install_dir() has already set it to the
+        # default NERSC directory, so both cases resolve to
+        # root/modulefiles.
+        #
+        module_directory = self.nersc_module_dir
         #
         # process_module() will handle the creation of the module directory.
         #
@@ -730,18 +1114,13 @@ class DesiInstall(object):
                                module_directory)
                 mod = process_module(self.module_file, self.module_keywords,
                                      module_directory)
-                # Remove write permission to avoid accidental changes
-                outfile = os.path.join(module_directory,
-                                       self.module_keywords['name'],
-                                       self.module_keywords['version'])
             except OSError as ose:
                 self.log.critical(ose.strerror)
                 raise DesiInstallException(ose.strerror)
             if self.options.default:
                 self.log.debug("default_module(self.module_keywords, '%s')",
                                module_directory)
-                dot_version = default_module(self.module_keywords,
-                                             module_directory)
+                default_module(self.module_keywords, module_directory)
 
         return mod
 
@@ -751,14 +1130,16 @@ class DesiInstall(object):
         Returns
         -------
         :class:`str`
-            The current working directory.  Because we're about to change it.
+            The current working directory.  The install steps do not change
+            it, but :meth:`cleanup` returns to it before removing
+            :envvar:`WORKING_DIR`.
         """
         os.environ['WORKING_DIR'] = self.working_dir
         os.environ['INSTALL_DIR'] = self.install_dir
         if self.baseproduct == 'desiutil':
             os.environ['DESIUTIL'] = self.install_dir
         else:
-            if self.baseproduct in os.environ['LOADEDMODULES']:
+            if self.baseproduct in loaded_modules():
                 m_command = 'switch'
             else:
                 m_command = 'load'
@@ -774,27 +1155,180 @@ class DesiInstall(object):
         self.original_dir = os.getcwd()
         return self.original_dir
 
+    def run_command(self, command, timeout=600):
+        """Run an external command to completion and capture its output.
+
+        Parameters
+        ----------
+        command : :class:`list`
+            The command to run.
+        timeout : :class:`int`, optional
+            Give up on the command after this many seconds. Set to ``None``
+            to wait indefinitely.
+
+        Returns
+        -------
+        :func:`tuple`
+            The return code, standard output and standard error of the command.
+
+        Raises
+        ------
+        DesiInstallException
+            If the command does not finish before `timeout`.
+        """
+        try:
+            proc = run(command, capture_output=True, text=True, timeout=timeout)
+        except TimeoutExpired:
+            message = "Timeout after {0:d} seconds: {1}".format(timeout,
+                                                                ' '.join(command))
+            self.log.critical(message)
+            raise DesiInstallException(message)
+        return proc.returncode, proc.stdout, proc.stderr
+
+    def start_command(self, command, **kwargs):
+        """Start an external command without waiting for it to finish.
+
+        Standard output is only captured if it will actually be logged.
+
+        Parameters
+        ----------
+        command : :class:`list`
+            The command to run.
+        kwargs : :class:`dict`
+            Additional keyword arguments passed to :class:`subprocess.Popen`.
+
+        Returns
+        -------
+        :class:`subprocess.Popen`
+            The running process.
+        """
+        if self.log.isEnabledFor(DEBUG):
+            stdout = PIPE
+        else:
+            stdout = DEVNULL
+        return Popen(command, universal_newlines=True,
+                     stdout=stdout, stderr=PIPE, **kwargs)
+
+    def wait_command(self, proc):
+        """Log the output of a command started by :meth:`start_command`
+        as it arrives, and wait for the command to finish.
+
+        Parameters
+        ----------
+        proc : :class:`subprocess.Popen`
+            The running process.
+
+        Returns
+        -------
+        :func:`tuple`
+            The return code of the command and (the last 1000 lines of)
+            its standard error.
+        """
+        err = deque(maxlen=1000)
+        if proc.stdout is None:
+            err.extend(proc.stderr)
+        else:
+            reader = Thread(target=err.extend, args=(proc.stderr,))
+            reader.start()
+            for line in proc.stdout:
+                self.log.debug(line.rstrip())
+            reader.join()
+        proc.wait()
+        return proc.returncode, ''.join(err)
+
+    def copy_install(self):
+        """Copy the downloaded code to the install directory.
+
+        If the working directory and the install directory are on the same
+        filesystem, and the working directory will be removed after the
+        install, files are hard-linked instead of copied.  Otherwise files
+        are copied in parallel.
+
+        Returns
+        -------
+        :class:`str`
+            The method used to populate the install directory, or ``None``
+            in test mode.
+        """
+        if self.options.test:
+            self.log.debug("Test mode. Skipping copy of %s to %s.",
+                           self.working_dir, self.install_dir)
+            return None
+        link = False
+        if not self.options.keep:
+            #
+            # The install directory does not exist yet, so compare against
+            # its closest existing parent.
+            #
+            parent = os.path.dirname(self.install_dir)
+            while parent and not os.path.exists(parent):
+                parent = os.path.dirname(parent)
+            try:
+                link = (os.stat(self.working_dir).st_dev ==
+                        os.stat(parent).st_dev)
+            except OSError:
+                link = False
+        if link:
+            self.log.debug("shutil.copytree('%s', '%s', copy_function=os.link)",
+                           self.working_dir, self.install_dir)
+            try:
+                shutil.copytree(self.working_dir, self.install_dir,
+                                copy_function=os.link)
+            except (OSError, shutil.Error) as e:
+                #
+                # For example, install_dir is on another filesystem after all.
+                #
+                self.log.debug("Hard links failed, falling back to copy: %s", e)
+                link = False
+                if os.path.exists(self.install_dir):
+                    self.unlock_permissions()
+                    self.remove_tree(self.install_dir)
+        if not link:
+            self.log.debug("Copying %s to %s.",
+                           self.working_dir, self.install_dir)
+            #
+            # Create the directory structure, while the contents of
+            # individual files are copied by a pool of threads.
+            # Directory modes are only copied once all files are in place,
+            # since a read-only directory would reject later copies.
+            #
+            directories = list()
+            with ThreadPoolExecutor(max_workers=self.options.jobs) as executor:
+                copies = list()
+                for dirpath, dirnames, filenames in os.walk(self.working_dir,
+                                                            followlinks=True):
+                    dst = os.path.join(self.install_dir,
+                                       os.path.relpath(dirpath, self.working_dir))
+                    os.makedirs(dst)
+                    directories.append((dirpath, dst))
+                    for f in filenames:
+                        copies.append(executor.submit(shutil.copy2,
+                                                      os.path.join(dirpath, f),
+                                                      os.path.join(dst, f)))
+                for c in copies:
+                    c.result()
+            for src, dst in reversed(directories):
+                shutil.copystat(src, dst)
+        return 'link' if link else 'copy'
+
     def install(self):
         """Run setup.py, etc.
         """
-        if (self.build_type == set(['plain']) or self.is_branch):
+        #
+        # build_type probes the filesystem, so only evaluate it once.
+        #
+        build_type = self.build_type
+        if (build_type == frozenset(['plain']) or self.is_branch):
             #
             # For certain installs, all that is needed is to copy the
             # downloaded code to the install directory.
             #
-            self.log.debug("shutil.copytree('%s', '%s')",
-                           self.working_dir, self.install_dir)
-            if self.options.test:
-                self.log.debug("Test mode. Skipping copy of %s to %s.",
-                               self.working_dir, self.install_dir)
-            else:
-                shutil.copytree(self.working_dir, self.install_dir)
+            self.copy_install()
         else:
             #
             # Run a 'real' install
             #
-            # os.chdir(self.working_dir)
-            if 'py' in self.build_type:
+            if 'py' in build_type:
                 #
                 # For Python installs, a site-packages directory needs to
                 # exist.  We may need to manipulate sys.path to include this
@@ -807,26 +1341,35 @@ class DesiInstall(object):
                     self.log.debug("Test Mode.  Skipping creation of %s.",
                                    lib_dir)
                 else:
-                    self.log.debug("os.makedirs('%s')", lib_dir)
+                    self.log.debug("os.makedirs('%s', exist_ok=True)", lib_dir)
                     try:
-                        os.makedirs(lib_dir)
+                        os.makedirs(lib_dir, exist_ok=True)
                     except OSError as ose:
                         self.log.critical(ose.strerror)
                         raise DesiInstallException(ose.strerror)
                     if lib_dir not in sys.path:
-                        try:
-                            newpythonpath = (lib_dir + ':' +
-                                             os.environ['PYTHONPATH'])
-                        except KeyError:
-                            newpythonpath = lib_dir
-                        os.environ['PYTHONPATH'] = newpythonpath
-                        sys.path.insert(int(sys.path[0] == ''), lib_dir)
+                        #
+                        # Trailing separators would add an empty entry,
+                        # i.e. the current directory, to the search path.
+                        #
+                        pythonpath = os.environ.get('PYTHONPATH', '').rstrip(os.pathsep)
+                        if pythonpath:
+                            os.environ['PYTHONPATH'] = lib_dir + os.pathsep + pythonpath
+                        else:
+                            os.environ['PYTHONPATH'] = lib_dir
+                        sys.path.insert(int(len(sys.path) > 0 and sys.path[0] == ''), lib_dir)
                 #
                 # Ready to python setup.py
                 #
                 # command = [sys.executable, 'setup.py', 'install',
                 #            '--prefix={0}'.format(self.install_dir)]
+                #
+                # Build requirements are already part of the DESI
+                # environment, so do not download them into a fresh
+                # isolated build environment for every install.
+                #
                 command = [sys.executable, '-m', 'pip', 'install', '--no-deps',
+                           '--no-build-isolation',
                            '--disable-pip-version-check', '--ignore-installed',
                            '--no-warn-script-location',
                            '--prefix={0}'.format(self.install_dir), '.']
@@ -835,17 +1378,20 @@ class DesiInstall(object):
                     # self.log.debug("Test Mode.  Skipping 'python setup.py install'.")
                     self.log.debug("Test Mode. Skipping 'pip install'.")
                 else:
-                    os.chdir(self.working_dir)
-                    proc = Popen(command, universal_newlines=True,
-                                 stdout=PIPE, stderr=PIPE)
-                    out, err = proc.communicate()
-                    self.log.debug(out)
+                    status, err = self.wait_command(self.start_command(command,
+                                                                       cwd=self.working_dir))
+                    if status == 0:
+                        #
+                        # Drop warnings that are known to be harmless.
+                        #
+                        err = '\n'.join([l for l in err.splitlines()
+                                         if l and not _ignore_install_warning.search(l)])
                     if len(err) > 0:
                         #
                         # Pass STDERR messages to the user, but do not
                         # raise an error unless the return code was non-zero.
                         #
-                        if proc.returncode == 0:
+                        if status == 0:
                             message = ("Pip emitted messages on STDERR; these can probably be ignored:\n" +
                                        err)
                             self.log.warning(message)
@@ -859,29 +1405,31 @@ class DesiInstall(object):
             # installation or we still need to compile the C/C++ product
             # (we had to construct doc/Makefile first).
             #
-            if 'make' in self.build_type or 'src' in self.build_type:
-                if 'src' in self.build_type:
-                    command = ['make', '-C', 'src', 'all']
+            if 'make' in build_type or 'src' in build_type:
+                #
+                # Limit parallel jobs by load average too, since
+                # login nodes are shared.
+                #
+                jobs = str(self.options.jobs)
+                if 'src' in build_type:
+                    command = ['make', '-j', jobs, '-l', jobs, '-C', 'src', 'all']
                 else:
-                    command = ['make', '-j', '8', 'install']
+                    command = ['make', '-j', jobs, '-l', jobs, 'install']
                 self.log.debug(' '.join(command))
                 if self.options.test:
                     self.log.debug("Test Mode.  Skipping 'make install'.")
                 else:
-                    if 'src' in self.build_type:
-                        os.chdir(self.install_dir)
+                    if 'src' in build_type:
+                        cwd = self.install_dir
                     else:
-                        os.chdir(self.working_dir)
-                    proc = Popen(command, universal_newlines=True,
-                                 stdout=PIPE, stderr=PIPE)
-                    out, err = proc.communicate()
-                    self.log.debug(out)
+                        cwd = self.working_dir
+                    status, err = self.wait_command(self.start_command(command, cwd=cwd))
                     if len(err) > 0:
                         #
                         # Pass STDERR messages to the user, but do not
                         # raise an error unless the return code was non-zero.
                         #
-                        if proc.returncode == 0:
+                        if status == 0:
                             message = ("Make emitted messages on STDERR; these can probably be ignored:\n" +
                                        err)
                             self.log.warning(message)
@@ -892,28 +1440,83 @@ class DesiInstall(object):
                             raise DesiInstallException(message)
         return
 
-    def get_extra(self):
+    def get_extra(self, wait=True):
         """Download any additional data not included in the code repository.
 
         This is done here so that :envvar:`INSTALL_DIR` is defined *and*
         exists.
+
+        Parameters
+        ----------
+        wait : :class:`bool`, optional
+            If ``False``, start the download script in the background and
+            return immediately.  :meth:`wait_extra` must then be called
+            to collect the result, or :meth:`stop_extra` to abandon it.
         """
+        self.extra_proc = None
+        self.extra_status = None
+        if self.options.test:
+            self.log.debug('Test Mode. Skipping install of extra data.')
+            return
         extra_script = os.path.join(self.working_dir, 'etc',
                                     '{0}_data.sh'.format(self.baseproduct))
         if os.path.exists(extra_script):
             self.log.debug("Detected extra script: %s.", extra_script)
-            if self.options.test:
-                self.log.debug('Test Mode. Skipping install of extra data.')
-            else:
-                proc = Popen([extra_script], universal_newlines=True,
-                             stdout=PIPE, stderr=PIPE)
-                out, err = proc.communicate()
-                status = proc.returncode
-                self.log.debug(out)
-                if status != 0 and len(err) > 0:
-                    message = "Error grabbing extra data: {0}".format(err)
-                    self.log.critical(message)
-                    raise DesiInstallException(message)
+            #
+            # Run the script in its own process group, so that any
+            # downloads it starts can be stopped along with it.
+            #
+            self.extra_proc = self.start_command([extra_script],
+                                                 start_new_session=True)
+            #
+            # Read the output of the script as it arrives, otherwise
+            # a script that writes a lot of output will fill the pipe and
+            # stall until wait_extra() is called.
+            #
+            executor = ThreadPoolExecutor(max_workers=1)
+            self.extra_status = executor.submit(self.wait_command,
+                                                self.extra_proc)
+            executor.shutdown(wait=False)
+        if wait:
+            self.wait_extra()
+        return
+
+    def wait_extra(self):
+        """Wait for any download started by :meth:`get_extra` to finish.
+
+        Raises
+        ------
+        DesiInstallException
+            If the download script failed.
+        """
+        proc = getattr(self, 'extra_proc', None)
+        if proc is None:
+            return
+        self.extra_proc = None
+        status, err = self.extra_status.result()
+        self.extra_status = None
+        if status != 0 and len(err) > 0:
+            message = "Error grabbing extra data: {0}".format(err)
+            self.log.critical(message)
+            raise DesiInstallException(message)
+        return
+
+    def stop_extra(self):
+        """Terminate any download started by :meth:`get_extra`, for
+        example, because a later install step failed.
+        """
+        proc = getattr(self, 'extra_proc', None)
+        if proc is None:
+            return
+        self.extra_proc = None
+        self.log.debug("Terminating extra script.")
+        try:
+            os.killpg(proc.pid, SIGTERM)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        self.extra_status.result()
+        self.extra_status = None
         return
 
     def compile_branch(self):
@@ -927,16 +1530,13 @@ class DesiInstall(object):
                 if self.options.test:
                     self.log.debug('Test Mode. Skipping compile script.')
                 else:
-                    current_dir = os.getcwd()
-                    self.log.debug("os.chdir('%s')", self.install_dir)
-                    os.chdir(self.install_dir)
-                    proc = Popen([compile_script, sys.executable], universal_newlines=True,
-                                 stdout=PIPE, stderr=PIPE)
-                    out, err = proc.communicate()
-                    status = proc.returncode
-                    self.log.debug(out)
-                    self.log.debug("os.chdir('%s')", current_dir)
-                    os.chdir(current_dir)
+                    #
+                    # Compilation can produce a lot of output, so log it
+                    # as it arrives.
+                    #
+                    status, err = self.wait_command(self.start_command([compile_script,
+                                                                        sys.executable],
+                                                                       cwd=self.install_dir))
                     if status != 0 and len(err) > 0:
                         message = "Error compiling code: {0}".format(err)
                         self.log.critical(message)
@@ -958,9 +1558,9 @@ class DesiInstall(object):
         if self.options.bootstrap:
             desiInstall = os.path.join(self.install_dir, 'bin', 'desiInstall')
             with open(desiInstall, 'r') as d:
-                lines = d.readlines()
-            self.log.debug("%s", lines[0].strip())
-            if self.options.anaconda not in lines[0]:
+                shebang = d.readline()
+            self.log.debug("%s", shebang.strip())
+            if self.options.anaconda not in shebang:
                 message = ("desiInstall executable ({0}) does not contain " +
                            "an explicit desiconda version " +
                            "({1})!").format(desiInstall, self.options.anaconda)
@@ -971,6 +1571,10 @@ class DesiInstall(object):
     def permissions(self):
         """Set permissions on installed software.
         """
+        if self.options.test:
+            self.log.debug('Test Mode. Skipping setting permissions on %s.',
+                           self.install_dir)
+            return
         read_file = stat.S_IRUSR | stat.S_IRGRP
         if self.options.world:
             read_file |= stat.S_IROTH
@@ -983,23 +1587,33 @@ class DesiInstall(object):
             read_exec |= stat.S_IWUSR
             read_dir |= stat.S_IWUSR
         #
-        # Recursively set permissions from the bottom up.
+        # Recursively set permissions from the bottom up.  This may touch
+        # thousands of files, so only format debug messages if they
+        # will actually be logged.
         #
+        debug = self.log.isEnabledFor(DEBUG)
         for dirpath, dirnames, filenames in os.walk(self.install_dir, topdown=False):
             for f in filenames:
                 fname = os.path.join(dirpath, f)
                 if os.path.islink(fname):
                     continue
-                executable = (stat.S_IMODE(os.stat(fname).st_mode) & stat.S_IXUSR) != 0
-                if executable:
-                    self.log.debug("os.chmod('%s', %s)", fname, read_exec)
-                    os.chmod(fname, read_exec)
+                mode = stat.S_IMODE(os.stat(fname).st_mode)
+                if (mode & stat.S_IXUSR) != 0:
+                    new_mode = read_exec
                 else:
-                    self.log.debug("os.chmod('%s', %s)", fname, read_exec)
-                    os.chmod(fname, read_file)
+                    new_mode = read_file
+                #
+                # Avoid a redundant chmod if the file is already correct.
+                #
+                if mode != new_mode:
+                    if debug:
+                        self.log.debug("os.chmod('%s', %s)", fname, new_mode)
+                    os.chmod(fname, new_mode)
             for d in dirnames:
-                self.log.debug("os.chmod('%s', %s)", os.path.join(dirpath, d), read_dir)
-                os.chmod(os.path.join(dirpath, d), read_dir)
+                dname = os.path.join(dirpath, d)
+                if debug:
+                    self.log.debug("os.chmod('%s', %s)", dname, read_dir)
+                os.chmod(dname, read_dir)
         #
         # Finally set permissions on the top directory.
         #
@@ -1016,11 +1630,9 @@ class DesiInstall(object):
         """
         command = ['chmod', '-R', 'u+w', self.install_dir]
         self.log.debug(' '.join(command))
-        proc = Popen(command, universal_newlines=True,
-                     stdout=PIPE, stderr=PIPE)
-        out, err = proc.communicate()
+        status, out, err = self.run_command(command)
         self.log.debug(out)
-        return proc.returncode
+        return status
 
     def cleanup(self):
         """Clean up after the install.
@@ -1030,13 +1642,13 @@ class DesiInstall(object):
         :class:`bool`
             Returns ``True``
         """
+        if self.options.test:
+            self.log.debug('Test Mode. Skipping cleanup of %s.', self.working_dir)
+            return True
         self.log.debug("os.chdir('%s')", self.original_dir)
-        if not self.options.test:
-            os.chdir(self.original_dir)
+        os.chdir(self.original_dir)
         if not self.options.keep:
-            self.log.debug("shutil.rmtree('%s')", self.working_dir)
-            if not self.options.test:
-                shutil.rmtree(self.working_dir)
+            self.remove_tree(self.working_dir)
         return True
 
     def run(self):  # pragma: no cover
@@ -1053,21 +1665,45 @@ class DesiInstall(object):
             self.sanity_check()
             fullproduct, baseproduct, baseversion = self.get_product_version()
             self.identify_branch()
-            self.verify_url()
-            self.get_code()
+            if self.github or self.options.test:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    self.get_code(verified=executor.submit(self.verify_url))
+            else:
+                #
+                # svn export or checkout reports a bad URL by itself, so
+                # a separate svn ls would only cost another connection.
+                # In test mode there is no export, so the URL is still
+                # checked with svn ls.
+                #
+                self.get_code()
             self.set_install_dir()
             self.start_modules()
             self.module_dependencies()
             self.install_module()
             self.prepare_environment()
             self.install()
-            self.get_extra()
-            self.compile_branch()
-            self.verify_bootstrap()
-            self.permissions()
+            #
+            # The extra data download only needs INSTALL_DIR to exist,
+            # so let it run while any branch code is compiled.
+            #
+            self.get_extra(wait=False)
+            try:
+                self.compile_branch()
+                self.verify_bootstrap()
+            except BaseException:
+                self.stop_extra()
+                raise
+            self.wait_extra()
         except DesiInstallException:
             return 1
-        self.cleanup()
+        #
+        # Setting permissions on the install directory is independent of
+        # removing the working directory.
+        #
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            fixed = executor.submit(self.permissions)
+            self.cleanup()
+            fixed.result()
         self.log.debug('run() complete.')
         return 0
 
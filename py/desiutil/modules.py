@@ -16,9 +16,7 @@ from argparse import ArgumentParser
 from shutil import which
 from stat import S_IRUSR, S_IRGRP, S_IROTH
 from configparser import ConfigParser
-from pkg_resources import resource_filename
 from . import __version__ as desiutilVersion
-from .io import unlock_file
 from .log import log
 
 
@@ -249,8 +247,7 @@ def process_module(module_file, module_keywords, module_dir):
     ----
     Module files are always installed with world-read permissions.
     """
-    if not os.path.isdir(os.path.join(module_dir, module_keywords['name'])):
-        os.makedirs(os.path.join(module_dir, module_keywords['name']))
+    os.makedirs(os.path.join(module_dir, module_keywords['name']), exist_ok=True)
     install_module_file = os.path.join(module_dir, module_keywords['name'],
                                        module_keywords['version'])
     with open(module_file) as m:
@@ -297,6 +294,10 @@ def _write_module_data(filename, data):
     data : :class:`str`
         The data to be written to `filename`.
     """
+    #
+    # desiutil.io imports astropy, which is slow and only needed here.
+    #
+    from .io import unlock_file
     with unlock_file(filename, 'w') as f:
         f.write(data)
     p = S_IRUSR | S_IRGRP | S_IROTH
@@ -347,6 +348,7 @@ def main():
 
     if not os.path.exists(module_file):
         log.warning("Could not find Module file: %s; using default.", module_file)
+        from pkg_resources import resource_filename
         module_file = resource_filename('desiutil', 'data/desiutil.module')
 
     process_module(module_file, module_keywords, options.modules)
@@ -3,17 +3,28 @@
 """Test desiutil.install.
 """
 import sys
+import tarfile
 import unittest
 from unittest.mock import patch, call, MagicMock, mock_open
-from os import chdir, environ, getcwd, mkdir, remove, rmdir
-from os.path import abspath, basename, isdir, join
-from shutil import rmtree
+from os import chdir, chmod, environ, getcwd, mkdir, remove, rmdir, stat
+from os.path import abspath, basename, dirname, isdir, isfile, join
+from shutil import copy2, rmtree, which
+from stat import S_IMODE, S_IWUSR
+from subprocess import CompletedProcess, Popen, TimeoutExpired
 from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
 from tempfile import mkdtemp
+from threading import Thread
+from time import sleep, time
 from logging import getLogger
 from pkg_resources import resource_filename
-from ..log import DEBUG
-from ..install import DesiInstall, DesiInstallException, dependencies
+from ..log import DEBUG, INFO
+from requests.exceptions import HTTPError
+from ..install import (DesiInstall, DesiInstallException, available_cpus,
+                       dependencies, dependency_order, get_session,
+                       known_products, loaded_modules, _ignore_install_warning)
 from .test_log import NullMemoryHandler
 
 
@@ -79,12 +90,83 @@ class TestInstall(unittest.TestCase):
         deps = dependencies(resource_filename('desiutil.test',
                                               't/generic_dependencies.txt'))
         self.assertEqual(set(deps), set(['astropy', 'desiutil/1.0.0']))
+        # Cached results are not shared, and change when the file changes.
+        deps.append('foo')
+        module_file = join(self.data_dir, 'test.module')
+        with open(module_file, 'w') as m:
+            m.write('module load astropy\n')
+        self.assertListEqual(dependencies(module_file), ['astropy'])
+        with open(module_file, 'a') as m:
+            m.write('module\tload  desiutil/1.0.0\n')
+            m.write('# module load foo\nmodule unload bar\nmodule loadbaz\n')
+        self.assertListEqual(dependencies(module_file), ['astropy', 'desiutil/1.0.0'])
+        deps = dependencies(resource_filename('desiutil.test',
+                                              't/generic_dependencies.txt'))
+        self.assertNotIn('foo', deps)
+
+    def test_dependency_order(self):
+        """Test sorting of dependencies.
+        """
+        deps = ['desispec/1.0', 'astropy', 'specter/2.0', 'desiutil/3.0']
+        self.assertListEqual(dependency_order(deps), deps)
+        module_dir = join(self.data_dir, 'modulefiles')
+        modulefiles = {'desispec/1.0': ['astropy', 'specter/2.0'],
+                       'specter/2.0': ['desiutil/3.0'],
+                       'desiutil/3.0': ['astropy']}
+        mkdir(module_dir)
+        for m in modulefiles:
+            mkdir(join(module_dir, m.split('/')[0]))
+            with open(join(module_dir, m), 'w') as mf:
+                mf.write('#%Module1.0\n')
+                for d in modulefiles[m]:
+                    mf.write('module load {0}\n'.format(d))
+        order = dependency_order(deps, module_dir)
+        self.assertEqual(set(order), set(deps))
+        for before, after in (('astropy', 'desiutil/3.0'),
+                              ('desiutil/3.0', 'specter/2.0'),
+                              ('specter/2.0', 'desispec/1.0')):
+            self.assertLess(order.index(before), order.index(after))
+        #
+        # A module file that loads a different version of a requested
+        # product leaves the order unchanged.
+        #
+        conflict = ['desispec/1.0', 'astropy', 'specter/1.5', 'desiutil/3.0']
+        self.assertListEqual(dependency_order(conflict, module_dir), conflict)
+        #
+        # Cyclic dependencies leave the order unchanged.
+        #
+        with open(join(module_dir, 'desiutil/3.0'), 'a') as mf:
+            mf.write('module load desispec/1.0\n')
+        self.assertListEqual(dependency_order(deps, module_dir), deps)
+
+    def test_available_cpus(self):
+        """Test counting CPUs available for parallel jobs.
+        """
+        with patch('os.sched_getaffinity', return_value={0, 1, 2}, create=True):
+            self.assertEqual(available_cpus(), 3)
+        with patch('os.sched_getaffinity', side_effect=AttributeError, create=True):
+            with patch('os.cpu_count', return_value=None):
+                self.assertEqual(available_cpus(), 1)
+
+    def test_loaded_modules(self):
+        """Test parsing of LOADEDMODULES.
+        """
+        with patch.dict('os.environ', {'LOADEDMODULES': 'FAKE'}):
+            del environ['LOADEDMODULES']
+            self.assertEqual(loaded_modules(), set())
+            environ['LOADEDMODULES'] = ''
+            self.assertEqual(loaded_modules(), set())
+            environ['LOADEDMODULES'] = 'numpy-mkl/1.0:desiutil/main:astropy'
+            self.assertEqual(loaded_modules(), set(['numpy-mkl', 'desiutil', 'astropy']))
+            self.assertNotIn('numpy', loaded_modules())
 
     def test_get_options(self):
         """Test the processing of desiInstall command-line arguments.
         """
         # Set a few environment variables for testing purposes.
         with patch.dict('os.environ', {'MODULESHOME': '/fake/module/directory'}):
+            if 'DESIINSTALL_JOBS' in environ:
+                del environ['DESIINSTALL_JOBS']
             default_namespace = Namespace(
                 additional=None,
                 anaconda=self.desiInstall.anaconda_version(),
@@ -92,6 +174,7 @@ class TestInstall(unittest.TestCase):
                 default=False,
                 force=False,
                 force_build_type=False,
+                jobs=available_cpus(),
                 keep=False,
                 moduleshome='/fake/module/directory',
                 product=u'NO PACKAGE',
@@ -120,6 +203,26 @@ class TestInstall(unittest.TestCase):
             self.assertLog(order=-1, message="Set log level to DEBUG.")
             self.assertLog(order=-2,
                            message="Called parse_args() with: -v product version")
+            #
+            # Set the number of parallel jobs.
+            #
+            options = self.desiInstall.get_options(['-j', '2', 'product', 'version'])
+            self.assertEqual(options.jobs, 2)
+            environ['DESIINSTALL_JOBS'] = '3'
+            options = self.desiInstall.get_options(['product', 'version'])
+            self.assertEqual(options.jobs, 3)
+            for jobs in ('0', '-1', 'many'):
+                with patch('sys.stderr'):
+                    with self.assertRaises(SystemExit):
+                        self.desiInstall.get_options(['-j', jobs, 'product', 'version'])
+            environ['DESIINSTALL_JOBS'] = 'many'
+            self.assertEqual(self.desiInstall.default_jobs(), available_cpus())
+            self.assertLog(order=-1,
+                           message="Ignoring invalid value of DESIINSTALL_JOBS: 'many'.")
+            options = self.desiInstall.get_options(['product', 'version'])
+            self.assertEqual(options.jobs, available_cpus())
+            options = self.desiInstall.get_options(['-j', '4', 'product', 'version'])
+            self.assertEqual(options.jobs, 4)
 
     def test_sanity_check(self):
         """Test the validation of command-line options.
@@ -173,6 +276,15 @@ class TestInstall(unittest.TestCase):
             out = self.desiInstall.get_product_version()
             self.assertEqual(out, (u'https://github.com/me/desiutil',
                                    'desiutil', '1.2.3'))
+            #
+            # Additional products do not leak into later installs.
+            #
+            self.assertEqual(known_products['desiutil'], 'https://github.com/desihub/desiutil')
+            self.assertNotIn('my_new_product', known_products)
+            options = self.desiInstall.get_options(['my_new_product', '1.2.3'])
+            out = self.desiInstall.get_product_version()
+            self.assertEqual(out, (u'https://github.com/desihub/my_new_product',
+                                   'my_new_product', '1.2.3'))
 
     def test_identify_branch(self):
         """Test identification of branch installs.
@@ -236,71 +348,271 @@ class TestInstall(unittest.TestCase):
         with self.assertRaises(DesiInstallException):
             self.desiInstall.verify_url(svn='which')
 
-    @patch('desiutil.install.Popen')
-    @patch('shutil.rmtree')
+    @patch('desiutil.install.get_session')
+    def test_verify_url_github(self, mock_session):
+        """Test the check for a valid GitHub URL, without network access.
+        """
+        options = self.desiInstall.get_options(['desispec', '0.1'])
+        out = self.desiInstall.get_product_version()
+        url = self.desiInstall.identify_branch()
+        self.assertTrue(self.desiInstall.verify_url())
+        mock_session().head.assert_called_once_with(url, timeout=(5, 30))
+        mock_session().head.return_value.status_code = 404
+        mock_session().head.return_value.raise_for_status.side_effect = HTTPError('404')
+        with self.assertRaises(DesiInstallException) as cm:
+            self.desiInstall.verify_url()
+        message = "Error 404 querying GitHub URL: {0}.".format(url)
+        self.assertEqual(str(cm.exception), message)
+        self.assertLog(-1, message)
+
+    def test_verify_url_unavailable(self):
+        """Test the check for a valid GitHub URL when the server keeps failing.
+        """
+        class Unavailable(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.send_response(503)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Unavailable)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with patch('desiutil.install._session', None):
+                session = get_session()
+                session.mount('http://', session.get_adapter('https://github.com'))
+                options = self.desiInstall.get_options(['desispec', '0.1'])
+                self.desiInstall.github = True
+                self.desiInstall.product_url = 'http://127.0.0.1:{0:d}/desispec'.format(server.server_port)
+                with self.assertRaises(DesiInstallException) as cm:
+                    self.desiInstall.verify_url()
+        finally:
+            server.shutdown()
+            server.server_close()
+        message = "Error 503 querying GitHub URL: {0}.".format(self.desiInstall.product_url)
+        self.assertEqual(str(cm.exception), message)
+        self.assertLog(-1, message)
+
+    def test_get_session(self):
+        """Test the shared HTTP session.
+        """
+        with patch('desiutil.install._session', None):
+            session = get_session()
+            self.assertIs(get_session(), session)
+            adapter = session.get_adapter('https://github.com/desihub/desiutil')
+            self.assertEqual(adapter.max_retries.total, 3)
+            self.assertIn(503, adapter.max_retries.status_forcelist)
+            self.assertFalse(adapter.max_retries.raise_on_status)
+            self.assertIn('gzip', session.headers['Accept-Encoding'])
+
+    @patch('desiutil.install.get_session')
+    def test_get_code_github_tag(self, mock_session):
+        """Test downloads of GitHub tag archives.
+        """
+        options = self.desiInstall.get_options(['desispec', 'v1.2.3'])
+        out = self.desiInstall.get_product_version()
+        url = self.desiInstall.identify_branch()
+        tgz = BytesIO()
+        with tarfile.open(fileobj=tgz, mode='w:gz') as tf:
+            data = b'Temporary file.\n'
+            info = tarfile.TarInfo('desispec-1.2.3/setup.py')
+            info.size = len(data)
+            tf.addfile(info, BytesIO(data))
+        tgz.seek(0)
+        r = mock_session().get().__enter__()
+        r.raw = tgz
+        mock_session().get.reset_mock()
+        original_dir = getcwd()
+        chdir(self.data_dir)
+        try:
+            self.desiInstall.get_code()
+        finally:
+            chdir(original_dir)
+        mock_session().get.assert_called_once_with(url, stream=True, timeout=(5, 30))
+        self.assertTrue(r.raw.decode_content)
+        self.assertEqual(self.desiInstall.working_dir, join(self.data_dir, 'desispec-1.2.3'))
+        self.assertTrue(isdir(self.desiInstall.working_dir))
+        #
+        # Errors.
+        #
+        r.status_code = 404
+        r.raise_for_status.side_effect = HTTPError('404')
+        chdir(self.data_dir)
+        try:
+            with self.assertRaises(DesiInstallException) as cm:
+                self.desiInstall.get_code()
+        finally:
+            chdir(original_dir)
+        message = "Error while downloading {0}, HTTP response was 404.".format(url)
+        self.assertEqual(str(cm.exception), message)
+        r.raise_for_status.side_effect = None
+        r.raw = BytesIO(b'Not a tar file.')
+        chdir(self.data_dir)
+        try:
+            with self.assertRaises(DesiInstallException) as cm:
+                self.desiInstall.get_code()
+        finally:
+            chdir(original_dir)
+        self.assertEqual(str(cm.exception), "tar error while expanding product code!")
+
+    def test_extract(self):
+        """Test expanding tar archives, with and without native tar.
+        """
+        options = self.desiInstall.get_options(['desispec', '1.2.3'])
+        original_dir = getcwd()
+        for name, tar in (('native', which('tar')), ('tarfile', None)):
+            tgz = BytesIO()
+            with tarfile.open(fileobj=tgz, mode='w:gz') as tf:
+                data = b'Temporary file.\n'
+                info = tarfile.TarInfo('desispec-{0}/setup.py'.format(name))
+                info.size = len(data)
+                tf.addfile(info, BytesIO(data))
+            tgz.seek(0)
+            chdir(self.data_dir)
+            try:
+                with patch('shutil.which', return_value=tar):
+                    self.assertTrue(self.desiInstall.extract(tgz))
+                    self.assertFalse(self.desiInstall.extract(BytesIO(b'Not a tar file.')))
+            finally:
+                chdir(original_dir)
+            with open(join(self.data_dir, 'desispec-{0}'.format(name), 'setup.py')) as s:
+                self.assertEqual(s.read(), 'Temporary file.\n')
+            rmtree(join(self.data_dir, 'desispec-{0}'.format(name)))
+
+    def test_extract_stderr(self):
+        """Test expanding tar archives with a tar that writes a lot of warnings.
+        """
+        options = self.desiInstall.get_options(['desispec', '1.2.3'])
+        tar = join(self.data_dir, 'tar')
+        with open(tar, 'w') as t:
+            t.write('#!/bin/sh\n')
+            t.write('head -c 200000 /dev/zero | tr "\\0" "x" >&2\n')
+            t.write('cat > /dev/null\n')
+        chmod(tar, 0o755)
+        with patch('shutil.which', return_value=tar):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                extracted = executor.submit(self.desiInstall.extract, BytesIO(b'x' * 200000))
+                self.assertTrue(extracted.result(timeout=60))
+
+        class BrokenDownload(object):
+            def read(self, size=-1):
+                raise ConnectionError('Connection reset.')
+
+        with open(tar, 'w') as t:
+            t.write('#!/bin/sh\n')
+            t.write('cat > /dev/null\n')
+        procs = list()
+
+        def popen(*args, **kwargs):
+            procs.append(Popen(*args, **kwargs))
+            return procs[-1]
+
+        with patch('shutil.which', return_value=tar):
+            with patch('desiutil.install.Popen', popen):
+                with self.assertRaises(ConnectionError):
+                    self.desiInstall.extract(BrokenDownload())
+        self.assertIsNotNone(procs[0].returncode)
+
+    @patch('desiutil.install.run')
+    @patch('desiutil.install.get_session')
+    def test_get_code_github_branch(self, mock_session, mock_run):
+        """Test downloads of GitHub branches.
+        """
+        options = self.desiInstall.get_options(['desispec', 'branches/main'])
+        out = self.desiInstall.get_product_version()
+        url = self.desiInstall.identify_branch()
+        mock_run.return_value = CompletedProcess([], 0, 'out', '')
+        original_dir = getcwd()
+        chdir(self.data_dir)
+        try:
+            self.desiInstall.get_code()
+        finally:
+            chdir(original_dir)
+        mock_session().head.assert_called_once_with('https://github.com/desihub/desispec/tree/main',
+                                                    allow_redirects=True, timeout=(5, 30))
+        mock_session().get.assert_not_called()
+        mock_run.assert_called_once_with(['git', 'clone', '-q', '--filter=blob:none',
+                                          '--single-branch', '-b', 'main',
+                                          'https://github.com/desihub/desispec.git',
+                                          join(self.data_dir, 'desispec-main')],
+                                         capture_output=True, text=True, timeout=None)
+        #
+        # A failed verify_url() or verify_branch() prevents the download.
+        #
+        mock_run.reset_mock()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            mock_session().head.return_value.status_code = 404
+            mock_session().head.return_value.raise_for_status.side_effect = HTTPError('404')
+            verified = executor.submit(self.desiInstall.verify_url)
+            with self.assertRaises(DesiInstallException) as cm:
+                self.desiInstall.get_code(verified=verified)
+        self.assertEqual(str(cm.exception), "Error 404 querying GitHub URL: {0}.".format(url))
+        with self.assertRaises(DesiInstallException) as cm:
+            self.desiInstall.get_code()
+        self.assertEqual(str(cm.exception), "Branch main does not appear to exist. HTTP response was 404.")
+        mock_run.assert_not_called()
+
+    @patch('desiutil.install.run')
+    @patch.object(DesiInstall, 'remove_tree')
     @patch('os.path.isdir')
-    def test_get_code_svn_export(self, mock_isdir, mock_rmtree, mock_popen):
+    def test_get_code_svn_export(self, mock_isdir, mock_rmtree, mock_run):
         """Test downloads via svn export.
         """
         options = self.desiInstall.get_options(['-v', 'plate_layout', '0.1'])
         out = self.desiInstall.get_product_version()
         url = self.desiInstall.identify_branch()
         mock_isdir.return_value = True
-        mock_proc = mock_popen()
-        mock_proc.communicate.return_value = ('out', '')
-        mock_proc.returncode = 0
+        mock_run.return_value = CompletedProcess([], 0, 'out', '')
         self.desiInstall.get_code()
         self.assertEqual(self.desiInstall.working_dir, join(abspath('.'), 'plate_layout-0.1'))
         mock_isdir.assert_called_once_with(self.desiInstall.working_dir)
         mock_rmtree.assert_called_once_with(self.desiInstall.working_dir)
-        mock_popen.assert_has_calls([call(['svn', '--non-interactive', '--username',
-                                           self.desiInstall.options.username, 'export',
-                                           'https://desi.lbl.gov/svn/code/focalplane/plate_layout/tags/0.1',
-                                           self.desiInstall.working_dir], universal_newlines=True, stdout=-1, stderr=-1),
-                                     call().communicate()])
+        mock_run.assert_called_once_with(['svn', '--non-interactive', '--username',
+                                          self.desiInstall.options.username, 'export',
+                                          'https://desi.lbl.gov/svn/code/focalplane/plate_layout/tags/0.1',
+                                          self.desiInstall.working_dir],
+                                         capture_output=True, text=True, timeout=None)
 
-    @patch('desiutil.install.Popen')
+    @patch('desiutil.install.run')
     @patch('os.path.isdir')
-    def test_get_code_svn_branch(self, mock_isdir, mock_popen):
+    def test_get_code_svn_branch(self, mock_isdir, mock_run):
         """Test downloads via svn checkout.
         """
         options = self.desiInstall.get_options(['-v', 'plate_layout', 'branches/test'])
         out = self.desiInstall.get_product_version()
         url = self.desiInstall.identify_branch()
         mock_isdir.return_value = False
-        mock_proc = mock_popen()
-        mock_proc.communicate.return_value = ('out', '')
-        mock_proc.returncode = 0
+        mock_run.return_value = CompletedProcess([], 0, 'out', '')
         self.desiInstall.get_code()
         self.assertEqual(self.desiInstall.working_dir, join(abspath('.'), 'plate_layout-test'))
         mock_isdir.assert_called_once_with(self.desiInstall.working_dir)
-        mock_popen.assert_has_calls([call(['svn', '--non-interactive', '--username',
-                                           self.desiInstall.options.username, 'checkout',
-                                           'https://desi.lbl.gov/svn/code/focalplane/plate_layout/branches/test',
-                                           self.desiInstall.working_dir], universal_newlines=True, stdout=-1, stderr=-1),
-                                     call().communicate()])
+        mock_run.assert_called_once_with(['svn', '--non-interactive', '--username',
+                                          self.desiInstall.options.username, 'checkout',
+                                          'https://desi.lbl.gov/svn/code/focalplane/plate_layout/branches/test',
+                                          self.desiInstall.working_dir],
+                                         capture_output=True, text=True, timeout=None)
 
-    @patch('desiutil.install.Popen')
+    @patch('desiutil.install.run')
     @patch('os.path.isdir')
-    def test_get_code_svn_error(self, mock_isdir, mock_popen):
+    def test_get_code_svn_error(self, mock_isdir, mock_run):
         """Test downloads via svn checkout with error handling.
         """
         options = self.desiInstall.get_options(['-v', 'plate_layout', '0.1'])
         out = self.desiInstall.get_product_version()
         url = self.desiInstall.identify_branch()
         mock_isdir.return_value = False
-        mock_proc = mock_popen()
-        mock_proc.communicate.return_value = ('out', 'err')
-        mock_proc.returncode = 1
+        mock_run.return_value = CompletedProcess([], 1, 'out', 'err')
         with self.assertRaises(DesiInstallException) as cm:
             self.desiInstall.get_code()
         self.assertEqual(self.desiInstall.working_dir, join(abspath('.'), 'plate_layout-0.1'))
         mock_isdir.assert_called_once_with(self.desiInstall.working_dir)
-        mock_popen.assert_has_calls([call(['svn', '--non-interactive', '--username',
-                                           self.desiInstall.options.username, 'export',
-                                           'https://desi.lbl.gov/svn/code/focalplane/plate_layout/tags/0.1',
-                                           self.desiInstall.working_dir], universal_newlines=True, stdout=-1, stderr=-1).
-                                     call().communicate()])
+        mock_run.assert_called_once_with(['svn', '--non-interactive', '--username',
+                                          self.desiInstall.options.username, 'export',
+                                          'https://desi.lbl.gov/svn/code/focalplane/plate_layout/tags/0.1',
+                                          self.desiInstall.working_dir],
+                                         capture_output=True, text=True, timeout=None)
         message = "svn error while downloading product code: err"
         self.assertLog(-1, message)
         self.assertEqual(str(cm.exception), message)
@@ -318,6 +630,29 @@ class TestInstall(unittest.TestCase):
         mock_isdir.assert_called_once_with(self.desiInstall.working_dir)
         self.assertLog(-1, 'Test Mode.')
 
+    def test_remove_tree(self):
+        """Test removal of directory trees.
+        """
+        options = self.desiInstall.get_options(['desiutil', 'branches/main'])
+        for name, rm in (('native', which('rm')), ('shutil', None)):
+            tree = join(self.data_dir, name)
+            mkdir(tree)
+            mkdir(join(tree, 'sub'))
+            with open(join(tree, 'sub', 'file.txt'), 'w') as f:
+                f.write('Temporary file.\n')
+            with patch('shutil.which', return_value=rm):
+                self.desiInstall.remove_tree(tree)
+            self.assertFalse(isdir(tree))
+        self.assertLog(-1, "shutil.rmtree('{0}')".format(tree))
+        #
+        # If rm fails, shutil.rmtree() reports the error.
+        #
+        with patch('desiutil.install.run') as mock_run:
+            mock_run.return_value = CompletedProcess([], 1, '', 'rm: failed')
+            with self.assertRaises(FileNotFoundError):
+                self.desiInstall.remove_tree(join(self.data_dir, 'does-not-exist'))
+        self.assertLog(-2, 'rm: failed')
+
     def test_build_type(self):
         """Test the determination of the build type.
         """
@@ -350,6 +685,14 @@ class TestInstall(unittest.TestCase):
             self.assertEqual(self.desiInstall.build_type,
                              set(['plain', tempdirs[t]]))
             rmdir(tempdir)
+        # A file named src is not a source directory.
+        with open(join(self.data_dir, 'src'), 'w') as tf:
+            tf.write('Temporary file.\n')
+        self.assertEqual(self.desiInstall.build_type, set(['plain']))
+        remove(join(self.data_dir, 'src'))
+        # A missing working directory.
+        self.desiInstall.working_dir = join(self.data_dir, 'missing')
+        self.assertEqual(self.desiInstall.build_type, set(['plain']))
         if old_working_dir is None:
             del self.desiInstall.working_dir
         else:
@@ -384,6 +727,10 @@ class TestInstall(unittest.TestCase):
         self.desiInstall.nersc = 'datatran'
         nersc_dir = self.desiInstall.default_nersc_dir()
         self.assertEqual(nersc_dir, '/global/common/software/desi/datatran/desiconda/frobulate')
+        self.assertIs(self.desiInstall.default_nersc_dir('datatran'), nersc_dir)
+        self.assertIn(('datatran', 'frobulate'), self.desiInstall._nersc_dir)
+        self.assertEqual(self.desiInstall.default_nersc_dir('perlmutter'),
+                         '/global/common/software/desi/perlmutter/desiconda/frobulate')
 
     def test_set_install_dir(self):
         """Test the determination of the install directory.
@@ -457,7 +804,7 @@ class TestInstall(unittest.TestCase):
     def test_module_dependencies(self, mock_exists, mock_dependencies):
         """Test module-loading dependencies.
         """
-        mock_dependencies.return_value = ['desiutil/main', 'foobar']
+        mock_dependencies.return_value = ['desiutil/main', 'foobar', 'desiutil/3.0', 'foobar']
         mock_exists.return_value = True
         options = self.desiInstall.get_options(['desispec', '1.9.5'])
         self.desiInstall.baseproduct = 'desispec'
@@ -502,20 +849,256 @@ class TestInstall(unittest.TestCase):
         self.assertEqual(self.desiInstall.nersc_module_dir,
                          '/global/cfs/cdirs/desi/test/modulefiles')
 
-    def test_install_module(self):
+    @patch('desiutil.install.default_module')
+    @patch('desiutil.install.process_module')
+    @patch('desiutil.install.configure_module')
+    def test_install_module(self, mock_configure, mock_process, mock_default):
         """Test installation of module files.
         """
-        pass
+        options = self.desiInstall.get_options(['--root', self.data_dir, '--default',
+                                                'desiutil', '1.2.3'])
+        self.desiInstall.nersc = None
+        self.desiInstall.is_branch = False
+        self.desiInstall.baseproduct = 'desiutil'
+        self.desiInstall.baseversion = '1.2.3'
+        self.desiInstall.working_dir = join(self.data_dir, 'desiutil-1.2.3')
+        self.desiInstall.module_file = join(self.desiInstall.working_dir, 'etc', 'desiutil.module')
+        mkdir(self.desiInstall.working_dir)
+        mock_configure.return_value = {'name': 'desiutil', 'version': '1.2.3'}
+        mock_process.return_value = 'module file'
+        mod = self.desiInstall.install_module()
+        self.assertEqual(mod, 'module file')
+        mock_configure.assert_called_once_with('desiutil', '1.2.3', join(self.data_dir, 'code'),
+                                               working_dir=self.desiInstall.working_dir, dev=False)
+        mock_process.assert_called_once_with(self.desiInstall.module_file,
+                                             mock_configure.return_value,
+                                             join(self.data_dir, 'modulefiles'))
+        mock_default.assert_called_once_with(mock_configure.return_value,
+                                             join(self.data_dir, 'modulefiles'))
+        mock_process.side_effect = OSError(13, 'Permission denied')
+        with self.assertRaises(DesiInstallException) as cm:
+            self.desiInstall.install_module()
+        self.assertEqual(str(cm.exception), 'Permission denied')
 
     def test_prepare_environment(self):
         """Test set up of build environment.
         """
         pass
 
-    def test_install(self):
-        """Test the actuall installation process.
+    def test_run_command(self):
+        """Test running a command to completion.
         """
-        pass
+        options = self.desiInstall.get_options(['desiutil', 'branches/main'])
+        status, out, err = self.desiInstall.run_command(['echo', 'foo'])
+        self.assertEqual(status, 0)
+        self.assertEqual(out, 'foo\n')
+        self.assertEqual(err, '')
+        status, out, err = self.desiInstall.run_command(['ls', join(self.data_dir, 'does-not-exist')])
+        self.assertNotEqual(status, 0)
+        self.assertGreater(len(err), 0)
+        with patch('desiutil.install.run') as mock_run:
+            mock_run.side_effect = TimeoutExpired(['svn', 'ls'], 600)
+            with self.assertRaises(DesiInstallException) as cm:
+                self.desiInstall.run_command(['svn', 'ls'])
+        message = "Timeout after 600 seconds: svn ls"
+        self.assertEqual(str(cm.exception), message)
+        self.assertLog(-1, message)
+
+    def test_start_command(self):
+        """Test running external commands.
+        """
+        options = self.desiInstall.get_options(['desiutil', '1.2.3'])
+        proc = self.desiInstall.start_command([sys.executable, '-c',
+                                               ('import sys; print("out1"); print("out2"); ' +
+                                                'print("err", file=sys.stderr); sys.exit(2)')])
+        status, err = self.desiInstall.wait_command(proc)
+        self.assertEqual(status, 2)
+        self.assertEqual(err, 'err\n')
+        self.assertLog(-2, 'out1')
+        self.assertLog(-1, 'out2')
+        #
+        # Standard output is discarded unless it will be logged.
+        #
+        self.desiInstall.log.setLevel(INFO)
+        proc = self.desiInstall.start_command([sys.executable, '-c', 'print("out3")'])
+        self.assertIsNone(proc.stdout)
+        status, err = self.desiInstall.wait_command(proc)
+        self.assertEqual(status, 0)
+        self.assertEqual(err, '')
+        self.assertLog(-1, 'out2')
+
+    def test_copy_install(self):
+        """Test copying code to the install directory.
+        """
+        working_dir = join(self.data_dir, 'desiutil-main')
+        mkdir(working_dir)
+        mkdir(join(working_dir, 'py'))
+        for f in ('README.rst', join('py', 'module.py')):
+            with open(join(working_dir, f), 'w') as w:
+                w.write('Temporary file.\n')
+        for keep, method in (([], 'link'), (['--keep'], 'copy')):
+            options = self.desiInstall.get_options(keep + ['--root', self.data_dir,
+                                                           'desiutil', 'branches/main'])
+            self.desiInstall.working_dir = working_dir
+            self.desiInstall.install_dir = join(self.data_dir, 'code', 'desiutil', 'main')
+            self.assertEqual(self.desiInstall.copy_install(), method)
+            for f in ('README.rst', join('py', 'module.py')):
+                src = stat(join(working_dir, f))
+                dst = stat(join(self.desiInstall.install_dir, f))
+                self.assertEqual(src.st_ino == dst.st_ino, method == 'link')
+            rmtree(self.desiInstall.install_dir)
+        options = self.desiInstall.get_options(['--test', '--root', self.data_dir,
+                                                'desiutil', 'branches/main'])
+        self.desiInstall.working_dir = working_dir
+        self.assertIsNone(self.desiInstall.copy_install())
+        self.assertFalse(isdir(self.desiInstall.install_dir))
+        self.assertLog(-1, "Test mode. Skipping copy of {0} to {1}.".format(working_dir,
+                                                                            self.desiInstall.install_dir))
+
+    def test_copy_install_link_error(self):
+        """Test falling back to a copy if hard links fail.
+        """
+        working_dir = join(self.data_dir, 'desiutil-main')
+        mkdir(working_dir)
+        mkdir(join(working_dir, 'py'))
+        for f in ('README.rst', join('py', 'module.py')):
+            with open(join(working_dir, f), 'w') as w:
+                w.write('Temporary file.\n')
+        options = self.desiInstall.get_options(['--root', self.data_dir,
+                                                'desiutil', 'branches/main'])
+        self.desiInstall.working_dir = working_dir
+        self.desiInstall.install_dir = join(self.data_dir, 'code', 'desiutil', 'main')
+        with patch('os.link', side_effect=OSError(18, 'Invalid cross-device link')):
+            self.assertEqual(self.desiInstall.copy_install(), 'copy')
+        for f in ('README.rst', join('py', 'module.py')):
+            src = stat(join(working_dir, f))
+            dst = stat(join(self.desiInstall.install_dir, f))
+            self.assertNotEqual(src.st_ino, dst.st_ino)
+        self.assertLog(-1, "Copying {0} to {1}.".format(working_dir,
+                                                        self.desiInstall.install_dir))
+
+    def test_copy_install_read_only(self):
+        """Test copying a read-only directory to the install directory.
+        """
+        working_dir = join(self.data_dir, 'desiutil-main')
+        mkdir(working_dir)
+        mkdir(join(working_dir, 'etc'))
+        with open(join(working_dir, 'etc', 'data.txt'), 'w') as w:
+            w.write('Temporary file.\n')
+        chmod(join(working_dir, 'etc'), 0o555)
+        options = self.desiInstall.get_options(['--keep', '--root', self.data_dir,
+                                                'desiutil', 'branches/main'])
+        self.desiInstall.working_dir = working_dir
+        self.desiInstall.install_dir = join(self.data_dir, 'code', 'desiutil', 'main')
+
+        def copy_writable(src, dst):
+            # Enforce directory permissions, even when running as root,
+            # and make the copy slow enough to expose any race.
+            sleep(0.1)
+            if not stat(dirname(dst)).st_mode & S_IWUSR:
+                raise PermissionError(13, 'Permission denied', dst)
+            return copy2(src, dst)
+
+        try:
+            with patch('shutil.copy2', copy_writable):
+                self.assertEqual(self.desiInstall.copy_install(), 'copy')
+            dst = join(self.desiInstall.install_dir, 'etc')
+            self.assertTrue(isfile(join(dst, 'data.txt')))
+            self.assertEqual(S_IMODE(stat(dst).st_mode), 0o555)
+        finally:
+            chmod(join(working_dir, 'etc'), 0o755)
+            if isdir(self.desiInstall.install_dir):
+                chmod(join(self.desiInstall.install_dir, 'etc'), 0o755)
+
+    def test_ignore_install_warning(self):
+        """Test filtering of harmless install warnings.
+        """
+        for l in ("warning: no previously-included files matching '*.pyc' found anywhere in distribution",
+                  "no previously-included directories found matching 'doc/_build'",
+                  "warning: no files found matching '*.rst'",
+                  "Using astropy-helpers from the astropy_helpers directory"):
+            self.assertIsNotNone(_ignore_install_warning.search(l))
+        for l in ("ERROR: Could not build wheels for desiutil",
+                  "WARNING: Running pip as the 'root' user"):
+            self.assertIsNone(_ignore_install_warning.search(l))
+
+    @patch('os.chdir')
+    @patch('os.makedirs')
+    @patch('desiutil.install.Popen')
+    def test_install(self, mock_popen, mock_makedirs, mock_chdir):
+        """Test the actual installation process.
+        """
+        options = self.desiInstall.get_options(['desispec', '1.2.3'])
+        self.desiInstall.is_branch = False
+        self.desiInstall.working_dir = join(self.data_dir, 'desispec-1.2.3')
+        self.desiInstall.install_dir = join(self.data_dir, 'code', 'desispec', '1.2.3')
+        self.desiInstall.module_keywords = {'pyversion': 'python3.10'}
+        mkdir(self.desiInstall.working_dir)
+        with open(join(self.desiInstall.working_dir, 'setup.py'), 'w') as s:
+            s.write('Temporary file.\n')
+        lib_dir = join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages')
+        mock_proc = mock_popen()
+        mock_proc.returncode = 0
+        mock_proc.stdout = ['out\n']
+        mock_proc.stderr = ["warning: no previously-included files matching '*.pyc' found\n"]
+        mock_popen.reset_mock()
+        with patch('sys.path', ['', '/usr/lib/python3.10']):
+            with patch.dict('os.environ', {'PYTHONPATH': '/my/python:'}):
+                self.desiInstall.install()
+                self.assertEqual(environ['PYTHONPATH'], lib_dir + ':/my/python')
+            self.assertListEqual(sys.path, ['', lib_dir, '/usr/lib/python3.10'])
+        mock_makedirs.assert_called_once_with(lib_dir, exist_ok=True)
+        mock_chdir.assert_not_called()
+        mock_popen.assert_called_once_with([sys.executable, '-m', 'pip', 'install', '--no-deps',
+                                            '--no-build-isolation',
+                                            '--disable-pip-version-check', '--ignore-installed',
+                                            '--no-warn-script-location',
+                                            '--prefix={0}'.format(self.desiInstall.install_dir), '.'],
+                                           cwd=self.desiInstall.working_dir,
+                                           stderr=-1, stdout=-1, universal_newlines=True)
+        self.assertLog(-1, 'out')
+        #
+        # Errors from pip.
+        #
+        mock_proc.returncode = 1
+        mock_proc.stderr = ['ERROR: bad\n']
+        with patch('sys.path', [lib_dir]):
+            with self.assertRaises(DesiInstallException) as cm:
+                self.desiInstall.install()
+        message = "Potentially serious error detected during pip installation:\nERROR: bad\n"
+        self.assertEqual(str(cm.exception), message)
+        self.assertLog(-1, message)
+
+    @patch('desiutil.install.Popen')
+    def test_install_make(self, mock_popen):
+        """Test installation of compiled code.
+        """
+        options = self.desiInstall.get_options(['-j', '4', 'desitemplate_cpp', '1.2.3'])
+        self.desiInstall.is_branch = False
+        self.desiInstall.working_dir = join(self.data_dir, 'desitemplate_cpp-1.2.3')
+        self.desiInstall.install_dir = join(self.data_dir, 'code', 'desitemplate_cpp', '1.2.3')
+        mkdir(self.desiInstall.working_dir)
+        with open(join(self.desiInstall.working_dir, 'Makefile'), 'w') as s:
+            s.write('Temporary file.\n')
+        mock_proc = mock_popen()
+        mock_proc.returncode = 0
+        mock_proc.stdout = ['out\n']
+        mock_proc.stderr = []
+        mock_popen.reset_mock()
+        self.desiInstall.install()
+        mock_popen.assert_called_once_with(['make', '-j', '4', '-l', '4', 'install'],
+                                           cwd=self.desiInstall.working_dir,
+                                           stderr=-1, stdout=-1, universal_newlines=True)
+        #
+        # Products with only a src directory are compiled in place.
+        #
+        remove(join(self.desiInstall.working_dir, 'Makefile'))
+        mkdir(join(self.desiInstall.working_dir, 'src'))
+        mock_popen.reset_mock()
+        self.desiInstall.install()
+        mock_popen.assert_called_once_with(['make', '-j', '4', '-l', '4', '-C', 'src', 'all'],
+                                           cwd=self.desiInstall.install_dir,
+                                           stderr=-1, stdout=-1, universal_newlines=True)
 
     @patch('os.path.exists')
     @patch('desiutil.install.Popen')
@@ -528,10 +1111,15 @@ class TestInstall(unittest.TestCase):
         mock_exists.return_value = True
         mock_proc = mock_popen()
         mock_proc.returncode = 0
-        mock_proc.communicate.return_value = ('out', 'err')
+        mock_proc.stdout = ['out\n']
+        mock_proc.stderr = ['err\n']
         self.desiInstall.get_extra()
-        mock_popen.assert_has_calls([call([join(self.desiInstall.working_dir, 'etc', 'desiutil_data.sh')], stderr=-1, stdout=-1, universal_newlines=True)],
+        mock_popen.assert_has_calls([call([join(self.desiInstall.working_dir, 'etc', 'desiutil_data.sh')],
+                                          start_new_session=True, stderr=-1, stdout=-1,
+                                          universal_newlines=True)],
                                     any_order=True)
+        mock_proc.wait.assert_called_once_with()
+        self.assertLog(-1, 'out')
         mock_popen.reset_mock()
         self.desiInstall.options.test = True
         self.desiInstall.get_extra()
@@ -540,20 +1128,86 @@ class TestInstall(unittest.TestCase):
         self.desiInstall.options.test = False
         mock_proc = mock_popen()
         mock_proc.returncode = 1
-        mock_proc.communicate.return_value = ('out', 'err')
+        mock_proc.stdout = ['out\n']
+        mock_proc.stderr = ['err']
         with self.assertRaises(DesiInstallException) as cm:
             self.desiInstall.get_extra()
         message = "Error grabbing extra data: err"
         self.assertLog(-1, message)
         self.assertEqual(str(cm.exception), message)
 
+    @patch('os.path.exists')
+    @patch('desiutil.install.Popen')
+    def test_get_extra_background(self, mock_popen, mock_exists):
+        """Test fetching extra data in the background.
+        """
+        options = self.desiInstall.get_options(['desiutil', 'branches/main'])
+        self.desiInstall.baseproduct = 'desiutil'
+        self.desiInstall.working_dir = join(self.data_dir, 'desiutil')
+        mock_exists.return_value = True
+        mock_proc = mock_popen()
+        mock_proc.returncode = 1
+        mock_proc.stdout = ['out\n']
+        mock_proc.stderr = ['err']
+        mock_popen.reset_mock()
+        self.desiInstall.get_extra(wait=False)
+        mock_popen.assert_called_once_with([join(self.desiInstall.working_dir, 'etc', 'desiutil_data.sh')],
+                                           start_new_session=True, stderr=-1, stdout=-1,
+                                           universal_newlines=True)
+        self.assertIs(self.desiInstall.extra_proc, mock_proc)
+        with self.assertRaises(DesiInstallException) as cm:
+            self.desiInstall.wait_extra()
+        self.assertEqual(str(cm.exception), "Error grabbing extra data: err")
+        self.assertIsNone(self.desiInstall.extra_proc)
+        #
+        # Nothing to wait for.
+        #
+        self.desiInstall.wait_extra()
+        self.desiInstall.stop_extra()
+
+    def test_get_extra_output(self):
+        """Test that a background extra script is not blocked by its output.
+        """
+        options = self.desiInstall.get_options(['desiutil', 'branches/main'])
+        self.desiInstall.baseproduct = 'desiutil'
+        self.desiInstall.working_dir = self.data_dir
+        mkdir(join(self.data_dir, 'etc'))
+        extra_script = join(self.data_dir, 'etc', 'desiutil_data.sh')
+        with open(extra_script, 'w') as s:
+            s.write('#!/bin/sh\n')
+            s.write('head -c 200000 /dev/zero | tr "\\0" "x" >&2\n')
+            s.write('echo done\n')
+        chmod(extra_script, 0o755)
+        self.desiInstall.get_extra(wait=False)
+        proc = self.desiInstall.extra_proc
+        #
+        # The script finishes even though nothing has called wait_extra().
+        #
+        self.assertEqual(proc.wait(timeout=60), 0)
+        self.desiInstall.wait_extra()
+        self.assertLog(-1, 'done')
+        #
+        # A script can be stopped if a later step fails.
+        #
+        with open(extra_script, 'w') as s:
+            s.write('#!/bin/sh\n')
+            s.write('sleep 60\n')
+            s.write('echo done\n')
+        self.desiInstall.get_extra(wait=False)
+        proc = self.desiInstall.extra_proc
+        start = time()
+        self.desiInstall.stop_extra()
+        self.assertLess(time() - start, 30)
+        self.assertIsNotNone(proc.returncode)
+        self.assertIsNone(self.desiInstall.extra_proc)
+        self.assertLog(-1, 'Terminating extra script.')
+
     @patch('os.chdir')
     @patch('os.path.exists')
     @patch('desiutil.install.Popen')
     def test_compile_branch(self, mock_popen, mock_exists, mock_chdir):
         """Test compiling code in certain cases.
         """
-        current_dir = getcwd()
         options = self.desiInstall.get_options(['fiberassign', 'branches/main'])
         self.desiInstall.baseproduct = 'fiberassign'
         self.desiInstall.is_branch = True
@@ -561,22 +1215,24 @@ class TestInstall(unittest.TestCase):
         mock_exists.return_value = True
         mock_proc = mock_popen()
         mock_proc.returncode = 0
-        mock_proc.communicate.return_value = ('out', 'err')
+        mock_proc.stdout = ['out\n']
+        mock_proc.stderr = ['err\n']
+        mock_popen.reset_mock()
         self.desiInstall.compile_branch()
-        mock_chdir.assert_has_calls([call(self.desiInstall.install_dir),
-                                     call(current_dir)])
+        mock_chdir.assert_not_called()
         mock_exists.assert_has_calls([call(join(self.desiInstall.install_dir, 'etc', 'fiberassign_compile.sh'))])
-        mock_popen.assert_has_calls([call([join(self.desiInstall.install_dir, 'etc', 'fiberassign_compile.sh'), sys.executable],
-                                          stderr=-1, stdout=-1, universal_newlines=True)], any_order=True)
+        mock_popen.assert_called_once_with([join(self.desiInstall.install_dir, 'etc', 'fiberassign_compile.sh'), sys.executable],
+                                           cwd=self.desiInstall.install_dir,
+                                           stderr=-1, stdout=-1, universal_newlines=True)
+        self.assertLog(-1, 'out')
         mock_popen.reset_mock()
         self.desiInstall.options.test = True
         self.desiInstall.compile_branch()
         self.assertLog(-1, 'Test Mode. Skipping compile script.')
-        mock_popen.reset_mock()
+        mock_popen.assert_not_called()
         self.desiInstall.options.test = False
-        mock_proc = mock_popen()
         mock_proc.returncode = 1
-        mock_proc.communicate.return_value = ('out', 'err')
+        mock_proc.stderr = ['err']
         with self.assertRaises(DesiInstallException) as cm:
             self.desiInstall.compile_branch()
         message = "Error compiling code: err"
@@ -633,8 +1289,12 @@ exit(main())
                                        (self.desiInstall.install_dir, ['bin', 'lib'], [])])
         self.desiInstall.permissions()
         mock_walk.assert_called_once_with(self.desiInstall.install_dir, topdown=False)
-        mock_chmod.assert_has_calls([call(join(self.desiInstall.install_dir, 'bin', 'executable'), 0o555),
-                                     call(join(self.desiInstall.install_dir, 'bin', 'README.txt'), 0o444),
+        #
+        # bin/executable already has the correct permissions.
+        #
+        self.assertNotIn(call(join(self.desiInstall.install_dir, 'bin', 'executable'), 0o555),
+                         mock_chmod.mock_calls)
+        mock_chmod.assert_has_calls([call(join(self.desiInstall.install_dir, 'bin', 'README.txt'), 0o444),
                                      call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil-1.2.3.dist-info', 'METADATA'), 0o444),
                                      call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil-1.2.3.dist-info', 'LICENSE.rst'), 0o444),
                                      call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil', '__pycache__', '__init__.cpython-3.10.pyc'), 0o444),
@@ -750,14 +1410,11 @@ exit(main())
                                        (self.desiInstall.install_dir, ['bin', 'lib'], [])])
         self.desiInstall.permissions()
         mock_walk.assert_called_once_with(self.desiInstall.install_dir, topdown=False)
+        #
+        # Plain files already have the correct permissions.
+        #
+        self.assertEqual([c for c in mock_chmod.mock_calls if c.args[1] == 0o640], [])
         mock_chmod.assert_has_calls([call(join(self.desiInstall.install_dir, 'bin', 'executable'), 0o750),
-                                     call(join(self.desiInstall.install_dir, 'bin', 'README.txt'), 0o640),
-                                     call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil-1.2.3.dist-info', 'METADATA'), 0o640),
-                                     call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil-1.2.3.dist-info', 'LICENSE.rst'), 0o640),
-                                     call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil', '__pycache__', '__init__.cpython-3.10.pyc'), 0o640),
-                                     call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil', '__pycache__', 'module.cpython-3.10.pyc'), 0o640),
-                                     call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil', '__init__.py'), 0o640),
-                                     call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil', 'module.py'), 0o640),
                                      call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil', '__pycache__'), 0o2750),
                                      call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil-1.2.3.dist-info'), 0o2750),
                                      call(join(self.desiInstall.install_dir, 'lib', 'python3.10', 'site-packages', 'desiutil'), 0o2750),
@@ -769,19 +1426,30 @@ exit(main())
         self.assertLog(-2, "os.chmod('%s', %s)" % (join(self.desiInstall.install_dir, 'lib'), 0o2750))
         self.assertLog(-1, "os.chmod('%s', %s)" % (self.desiInstall.install_dir, 0o2750))
 
-    @patch('desiutil.install.Popen')
-    def test_unlock_permissions(self, mock_popen):
+    @patch('os.walk')
+    @patch('os.chmod')
+    def test_permissions_test_mode(self, mock_chmod, mock_walk):
+        """Test the permission stage of the install in test mode.
+        """
+        options = self.desiInstall.get_options(['--test', 'desiutil', '1.2.3'])
+        self.desiInstall.install_dir = join(self.data_dir, 'desiutil')
+        self.desiInstall.is_branch = False
+        self.desiInstall.permissions()
+        mock_walk.assert_not_called()
+        mock_chmod.assert_not_called()
+        self.assertLog(-1, 'Test Mode. Skipping setting permissions on {0}.'.format(self.desiInstall.install_dir))
+
+    @patch('desiutil.install.run')
+    def test_unlock_permissions(self, mock_run):
         """Test unlocking installed directories to allow their removal.
         """
         options = self.desiInstall.get_options(['desiutil', 'branches/main'])
         self.desiInstall.install_dir = join(self.data_dir, 'desiutil')
-        mock_proc = mock_popen()
-        mock_proc.returncode = 0
-        mock_proc.communicate.return_value = ('out', 'err')
+        mock_run.return_value = CompletedProcess([], 0, 'out', 'err')
         status = self.desiInstall.unlock_permissions()
         self.assertEqual(status, 0)
-        mock_popen.assert_has_calls([call(['chmod', '-R', 'u+w', self.desiInstall.install_dir], stderr=-1, stdout=-1, universal_newlines=True)],
-                                    any_order=True)
+        mock_run.assert_called_once_with(['chmod', '-R', 'u+w', self.desiInstall.install_dir],
+                                         capture_output=True, text=True, timeout=600)
 
     def test_cleanup(self):
         """Test the cleanup stage of the install.
@@ -794,3 +1462,11 @@ exit(main())
         self.desiInstall.cleanup()
         self.assertEqual(getcwd(), self.desiInstall.original_dir)
         self.assertFalse(isdir(self.desiInstall.working_dir))
+        #
+        # Test mode.
+        #
+        options = self.desiInstall.get_options(['--test', 'desiutil', 'branches/main'])
+        mkdir(self.desiInstall.working_dir)
+        self.assertTrue(self.desiInstall.cleanup())
+        self.assertTrue(isdir(self.desiInstall.working_dir))
+        self.assertLog(-1, 'Test Mode. Skipping cleanup of {0}.'.format(self.desiInstall.working_dir))